@@ -4,25 +4,51 @@ FastAPI Backend with Vertex AI Gemini Integration for Physics-based Task Learnin
 """
 
 import asyncio
+import atexit
+import logging
+import logging.handlers
 import os
+import queue
+import random
+from math import hypot
 
+import orjson
 import vertexai
 import world_model
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from google.api_core import exceptions as api_exceptions
 from pydantic import BaseModel, Field
-from task import LEVELS
+from task import LEVELS, Action
 from vertexai.generative_models import GenerativeModel
 
 # Load environment variables
 load_dotenv()
 
+# Configure logging: handlers run on a QueueListener thread so emitting a
+# record never blocks the event loop
+logger = logging.getLogger("tars")
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+# 不正なLOG_LEVELで起動に失敗しないよう、未知の値はINFOとして扱う
+_log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+logger.setLevel(_log_level if _log_level in logging.getLevelNamesMapping() else logging.INFO)
+logger.propagate = False
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 # Initialize FastAPI app
-app = FastAPI(title="TARS - World Model API", version="2.0.0")
+app = FastAPI(
+    title="TARS - World Model API",
+    version="2.0.0",
+    default_response_class=ORJSONResponse,
+)
 
 # Configure CORS
 app.add_middleware(
@@ -39,15 +65,15 @@ PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "your-project-id")
 try:
     vertexai.init(project=PROJECT_ID, location="us-central1")
     model = GenerativeModel("gemini-2.0-flash-exp")
-    print(f"✅ Vertex AI initialized: {PROJECT_ID}")
+    logger.info("✅ Vertex AI initialized: %s", PROJECT_ID)
 except Exception as e:
-    print(f"⚠️  Vertex AI initialization failed: {e}")
-    print("ℹ️  Mock responses will be used for AI analysis.")
+    logger.warning("⚠️  Vertex AI initialization failed: %s", e)
+    logger.info("ℹ️  Mock responses will be used for AI analysis.")
     model = None
 
 # World Model Memory Stream (Episode-based Memory)
 episode_memory = world_model.MemoryStream()
-print(f"📚 Memory system initialized: {len(episode_memory.episodes)} memories loaded")
+logger.info("📚 Memory system initialized: %d memories loaded", episode_memory.episode_count)
 
 
 # ==================== Pydantic Models ====================
@@ -62,6 +88,15 @@ class WorldModelRequest(BaseModel):
     previous_actions: list[str] = Field(default=[], description="これまでの行動履歴")
 
 
+class EpisodeCompleteRequest(BaseModel):
+    """エピソード完了リクエスト"""
+
+    level_key: str = Field(description="レベルキー (tutorial, friction, obstacle, barrier)")
+    state: dict = Field(description="エピソード終了時のシミュレーション状態")
+    actions_taken: list[str] = Field(default=[], description="エピソード中の行動履歴")
+    reward: float = Field(default=0, description="エピソードで獲得した報酬")
+
+
 class WorldModelDecisionResponse(BaseModel):
     """World Model行動決定レスポンス"""
 
@@ -71,6 +106,36 @@ class WorldModelDecisionResponse(BaseModel):
     error: str = Field(default="", description="エラーメッセージ")
 
 
+# ==================== Static Payloads ====================
+
+# Actionのコンパイル済みシリアライザ（model_dumpの引数処理を経由せず直接呼ぶ）
+_ACTION_SERIALIZER = Action.__pydantic_serializer__
+
+# レベル設定とレベル名を事前に展開（ハンドラでの属性参照を省く）
+_LEVEL_CACHE = {key: (level, level.name) for key, level in LEVELS.items()}
+
+# Vertex AI未設定時のモックレスポンス（不変なので起動時に一度だけシリアライズ）
+_MOCK_DECISION_JSON = orjson.dumps(
+    WorldModelDecisionResponse(
+        reasoning="モックレスポンス: Vertex AIが未設定です",
+        action={
+            "type": "push",
+            "forceX": 50,
+            "forceY": 0,
+            "duration": 200,
+            "reason": "右に押す（デフォルト動作）",
+        },
+    ).model_dump()
+)
+
+# ヘルスチェックの固定フィールド（episode_countのみリクエスト毎に埋める）
+_HEALTH_TEMPLATE = {
+    "status": "healthy",
+    "vertex_ai": "connected" if model else "disconnected",
+    "project_id": PROJECT_ID,
+}
+
+
 # ==================== Endpoints ====================
 
 
@@ -83,12 +148,7 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {
-        "status": "healthy",
-        "vertex_ai": "connected" if model else "disconnected",
-        "project_id": PROJECT_ID,
-        "episode_count": len(episode_memory.episodes),
-    }
+    return ORJSONResponse({**_HEALTH_TEMPLATE, "episode_count": episode_memory.episode_count})
 
 
 @app.post("/api/world-model/decide", response_model=WorldModelDecisionResponse)
@@ -103,23 +163,15 @@ async def world_model_decide(request: WorldModelRequest):
         WorldModelDecisionResponse with reasoning and action
     """
     try:
-        level = LEVELS.get(request.level_key)
-        if not level:
+        entry = _LEVEL_CACHE.get(request.level_key)
+        if entry is None:
             raise HTTPException(status_code=400, detail=f"Invalid level key: {request.level_key}")
+        level = entry[0]
 
         if not model:
             # Fallback to mock response if Vertex AI not available
-            print("⚠️  Using default project ID, returning mock response")
-            return WorldModelDecisionResponse(
-                reasoning="モックレスポンス: Vertex AIが未設定です",
-                action={
-                    "type": "push",
-                    "forceX": 50,
-                    "forceY": 0,
-                    "duration": 200,
-                    "reason": "右に押す（デフォルト動作）",
-                },
-            )
+            logger.debug("⚠️  Using default project ID, returning mock response")
+            return Response(content=_MOCK_DECISION_JSON, media_type="application/json")
 
         # Call world model to analyze and decide with retry logic
         max_retries = 3
@@ -135,26 +187,29 @@ async def world_model_decide(request: WorldModelRequest):
                     memory_stream=episode_memory,
                 )
 
-                return WorldModelDecisionResponse(
+                # WorldModelResponseで検証済みの値なので再検証をスキップ
+                return WorldModelDecisionResponse.model_construct(
                     reasoning=response.reasoning,
-                    action=response.action.model_dump(by_alias=True),
+                    action=_ACTION_SERIALIZER.to_python(response.action, by_alias=True),
                 )
             except api_exceptions.ResourceExhausted:
                 if attempt < max_retries - 1:
-                    wait_time = (2**attempt) * 2  # Exponential backoff: 2s, 4s, 8s
-                    print(
-                        f"⏳ Quota exceeded, retrying in {wait_time}s (attempt {attempt + 1}/{max_retries})..."
+                    # Exponential backoff with jitter: 2s, 4s, 8s (+0-1s)
+                    # ジッターで同時に429を受けたリクエストの再送タイミングを分散
+                    wait_time = (2**attempt) * 2 + random.uniform(0, 1)
+                    logger.warning(
+                        "⏳ Quota exceeded, retrying in %.1fs (attempt %d/%d)...",
+                        wait_time,
+                        attempt + 1,
+                        max_retries,
                     )
                     await asyncio.sleep(wait_time)
                 else:
-                    print(f"❌ Quota exceeded after {max_retries} attempts")
+                    logger.error("❌ Quota exceeded after %d attempts", max_retries)
                     raise
 
     except Exception as e:
-        print(f"❌ World Model decision error: {e}")
-        import traceback
-
-        traceback.print_exc()
+        logger.exception("❌ World Model decision error")
 
         return WorldModelDecisionResponse(
             reasoning=f"エラーが発生しました: {str(e)}",
@@ -171,80 +226,85 @@ async def world_model_decide(request: WorldModelRequest):
 
 
 @app.post("/api/world-model/episode-complete")
-async def episode_complete(request: dict):
+async def episode_complete(request: EpisodeCompleteRequest):
     """
     エピソード完了時に呼ばれるエンドポイント
     エピソードの結果をメモリに追加
     """
     try:
-        level = LEVELS.get(request["level_key"])
-        if not level:
-            raise HTTPException(
-                status_code=400, detail=f"Invalid level key: {request['level_key']}"
-            )
+        entry = _LEVEL_CACHE.get(request.level_key)
+        if entry is None:
+            raise HTTPException(status_code=400, detail=f"Invalid level key: {request.level_key}")
+        level_name = entry[1]
 
-        state = request["state"]
-        actions_taken = request.get("actions_taken", [])
+        state = request.state
 
         # ゴールまでの最終距離を計算
         box_pos = state["box"]["position"]
         goal_pos = state["goal"]["position"]
-        dx = goal_pos["x"] - box_pos["x"]
-        dy = goal_pos["y"] - box_pos["y"]
-        final_distance = (dx**2 + dy**2) ** 0.5
+        final_distance = hypot(goal_pos["x"] - box_pos["x"], goal_pos["y"] - box_pos["y"])
 
         # メモリに追加
         episode = episode_memory.add_episode(
-            level_key=request["level_key"],
-            level_name=level.name,
+            level_key=request.level_key,
+            level_name=level_name,
             success=state.get("isSuccess", False),
             steps=state.get("step", 0),
             elapsed_time=state.get("elapsedTime", 0),
-            reward=request.get("reward", 0),
-            actions_taken=actions_taken,
+            reward=request.reward,
+            actions_taken=request.actions_taken,
             final_distance=final_distance,
         )
 
         # リフレクションを取得
-        reflection = episode_memory.get_reflection(request["level_key"])
-
-        return {
-            "success": True,
-            "episode_id": episode.episode_id,
-            "summary": episode.summary,
-            "key_insight": episode.key_insight,
-            "reflection": reflection.model_dump() if reflection else None,
-            "stats": episode_memory.get_stats(),
-        }
+        reflection = episode_memory.get_reflection(request.level_key)
+
+        return ORJSONResponse(
+            {
+                "success": True,
+                "episode_id": episode.episode_id,
+                "summary": episode.summary,
+                "key_insight": episode.key_insight,
+                "reflection": reflection.model_dump() if reflection else None,
+                "stats": episode_memory.get_stats(),
+            }
+        )
 
     except Exception as e:
-        print(f"❌ Episode complete error: {e}")
+        logger.exception("❌ Episode complete error")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.get("/api/world-model/memory")
 async def get_world_model_memory(level_key: str = None):
     """World Modelのメモリストリームを取得"""
+    # dictを直接ORJSONResponseで返し、jsonable_encoderによる再走査を省く
     if level_key:
-        return {
-            "level_key": level_key,
-            "reflection": (
-                episode_memory.get_reflection(level_key).model_dump()
-                if episode_memory.get_reflection(level_key)
-                else None
-            ),
-            "recent_episodes": [
-                ep.model_dump() for ep in episode_memory.get_recent_episodes(level_key, limit=5)
-            ],
-        }
+        return ORJSONResponse(
+            {
+                "level_key": level_key,
+                "reflection": (
+                    episode_memory.get_reflection(level_key).model_dump()
+                    if episode_memory.get_reflection(level_key)
+                    else None
+                ),
+                "recent_episodes": [
+                    ep.model_dump() for ep in episode_memory.get_recent_episodes(level_key, limit=5)
+                ],
+            }
+        )
     else:
-        return {
-            "stats": episode_memory.get_stats(),
-            "all_episodes": [ep.model_dump() for ep in episode_memory.episodes[-10:]],
-            "reflections": {
-                key: refl.model_dump() for key, refl in episode_memory.reflections.items()
-            },
-        }
+        return ORJSONResponse(
+            {
+                "stats": episode_memory.get_stats(),
+                "all_episodes": [
+                    ep.model_dump() for ep in episode_memory.get_latest_episodes(limit=10)
+                ],
+                "reflections": {
+                    key: refl.model_dump() for key, refl in episode_memory.reflections.items()
+                },
+            }
+        )
 
 
 # Mount static files
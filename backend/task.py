@@ -4,10 +4,12 @@ Task Configuration for World Model Experiment
 レベル設定とデータモデル
 """
 
-from dataclasses import dataclass, field
+from collections.abc import Mapping
+from dataclasses import dataclass
 from enum import StrEnum
+from types import MappingProxyType
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 # ==================== Data Models ====================
 
@@ -33,6 +35,8 @@ class ActionType(StrEnum):
 class Point(BaseModel):
     """2D座標"""
 
+    model_config = ConfigDict(frozen=True)
+
     x: float
     y: float
 
@@ -40,6 +44,8 @@ class Point(BaseModel):
 class Velocity(BaseModel):
     """速度ベクトル"""
 
+    model_config = ConfigDict(frozen=True)
+
     x: float
     y: float
 
@@ -47,6 +53,8 @@ class Velocity(BaseModel):
 class BoxState(BaseModel):
     """荷物の状態"""
 
+    model_config = ConfigDict(frozen=True)
+
     position: Point
     velocity: Velocity
     mass: float
@@ -57,6 +65,8 @@ class BoxState(BaseModel):
 class GoalState(BaseModel):
     """ゴールの状態"""
 
+    model_config = ConfigDict(frozen=True)
+
     position: Point
     radius: float = 30.0
 
@@ -92,7 +102,7 @@ class SimulationState(BaseModel):
 # ==================== Level Configuration ====================
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class LevelConfig:
     """レベル設定"""
 
@@ -106,52 +116,59 @@ class LevelConfig:
     time_limit: float = 30.0
     max_steps: int = 50
     available_barriers: int = 0
-    obstacles: list[dict] = field(default_factory=list)
-
-
-# 事前定義レベル
-LEVELS = {
-    TaskLevel.TUTORIAL: LevelConfig(
-        name="基礎：直線移動",
-        description="荷物を右に押してゴールへ",
-        box_position=Point(x=200, y=300),
-        goal_position=Point(x=600, y=300),
-        box_mass=10.0,
-        friction=0.5,
-        time_limit=60.0,
-        max_steps=20,
-    ),
-    TaskLevel.FRICTION: LevelConfig(
-        name="物理：摩擦係数",
-        description="滑りやすい荷物をコントロール",
-        box_position=Point(x=200, y=300),
-        goal_position=Point(x=600, y=300),
-        box_mass=10.0,
-        friction=0.1,  # 非常に滑る
-        time_limit=80.0,
-        max_steps=30,
-    ),
-    TaskLevel.OBSTACLE: LevelConfig(
-        name="障害：壁の回避",
-        description="壁を避けてゴールへ",
-        box_position=Point(x=200, y=300),
-        goal_position=Point(x=600, y=300),
-        box_mass=10.0,
-        friction=0.5,
-        time_limit=100.0,
-        max_steps=40,
-        obstacles=[{"type": "wall", "x": 400, "y": 200, "width": 20, "height": 400}],
-    ),
-    TaskLevel.BARRIER: LevelConfig(
-        name="戦略：誘導路作成",
-        description="バリアで滑り台を作り、安全にゴールへ",
-        box_position=Point(x=200, y=100),  # 高い位置
-        goal_position=Point(x=600, y=500),
-        box_mass=10.0,
-        friction=0.3,
-        time_limit=120.0,
-        max_steps=50,
-        available_barriers=3,
-        obstacles=[{"type": "pit", "x": 400, "y": 550, "width": 100, "height": 50}],
-    ),
-}
+    obstacles: tuple[Mapping, ...] = ()
+
+
+# 事前定義レベル（座標は既知の定数なのでmodel_constructで検証を省く）
+# 全リクエストで共有するため、障害物も含めて読み取り専用ビューにする
+LEVELS = MappingProxyType(
+    {
+        TaskLevel.TUTORIAL: LevelConfig(
+            name="基礎：直線移動",
+            description="荷物を右に押してゴールへ",
+            box_position=Point.model_construct(x=200.0, y=300.0),
+            goal_position=Point.model_construct(x=600.0, y=300.0),
+            box_mass=10.0,
+            friction=0.5,
+            time_limit=60.0,
+            max_steps=20,
+        ),
+        TaskLevel.FRICTION: LevelConfig(
+            name="物理：摩擦係数",
+            description="滑りやすい荷物をコントロール",
+            box_position=Point.model_construct(x=200.0, y=300.0),
+            goal_position=Point.model_construct(x=600.0, y=300.0),
+            box_mass=10.0,
+            friction=0.1,  # 非常に滑る
+            time_limit=80.0,
+            max_steps=30,
+        ),
+        TaskLevel.OBSTACLE: LevelConfig(
+            name="障害：壁の回避",
+            description="壁を避けてゴールへ",
+            box_position=Point.model_construct(x=200.0, y=300.0),
+            goal_position=Point.model_construct(x=600.0, y=300.0),
+            box_mass=10.0,
+            friction=0.5,
+            time_limit=100.0,
+            max_steps=40,
+            obstacles=(
+                MappingProxyType({"type": "wall", "x": 400, "y": 200, "width": 20, "height": 400}),
+            ),
+        ),
+        TaskLevel.BARRIER: LevelConfig(
+            name="戦略：誘導路作成",
+            description="バリアで滑り台を作り、安全にゴールへ",
+            box_position=Point.model_construct(x=200.0, y=100.0),  # 高い位置
+            goal_position=Point.model_construct(x=600.0, y=500.0),
+            box_mass=10.0,
+            friction=0.3,
+            time_limit=120.0,
+            max_steps=50,
+            available_barriers=3,
+            obstacles=(
+                MappingProxyType({"type": "pit", "x": 400, "y": 550, "width": 100, "height": 50}),
+            ),
+        ),
+    }
+)
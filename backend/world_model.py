@@ -5,11 +5,58 @@ Gemini APIを使った空間知能システム
 物理シミュレーションを観察し、次の行動を推論する
 """
 
-import json
+import asyncio
+import logging
+import os
+import time
+from collections import Counter, defaultdict, deque
 from datetime import datetime
+from itertools import islice
+from math import hypot
 
 from pydantic import BaseModel, Field
-from task import Action, LevelConfig
+from task import LEVELS, Action, LevelConfig
+from vertexai.generative_models import GenerationConfig, Part
+
+logger = logging.getLogger("tars")
+
+
+class TokenBucket:
+    """一定レートでトークンを補充するレートリミッタ（QPM上限の平準化用）"""
+
+    def __init__(self, rate_per_minute: float, capacity: float = 1.0):
+        self.rate = rate_per_minute / 60.0  # tokens/sec
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """トークンを1つ取得（不足していれば補充まで待機、待機順はFIFO）"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                elapsed = now - self.updated_at
+                self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Gemini APIへの同時リクエスト数の上限（QPM超過による429の連鎖を防ぐ）
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "32"))
+_gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+# GEMINI_QPMを指定すると、429を受けてからバックオフする代わりに事前に送信間隔を空ける
+GEMINI_QPM = float(os.getenv("GEMINI_QPM", "0"))
+_gemini_bucket = TokenBucket(GEMINI_QPM) if GEMINI_QPM > 0 else None
+
+# メモリ上に保持するエピソード数の上限（古いエピソードは破棄される）
+MAX_EPISODES_IN_MEMORY = int(os.getenv("MAX_EPISODES_IN_MEMORY", "1000"))
+# レベル毎に保持する最近のエピソード数（get_recent_episodesのlimitの上限）
+RECENT_EPISODES_PER_LEVEL = 16
 
 
 class EpisodeMemory(BaseModel):
@@ -45,9 +92,43 @@ class MemoryStream:
     """記憶ストリーム（Generative Agentsのメモリシステム）"""
 
     def __init__(self):
-        self.episodes: list[EpisodeMemory] = []
+        # 直近のエピソードのみ保持し、メモリ使用量を一定に抑える
+        self.episodes: deque[EpisodeMemory] = deque(maxlen=MAX_EPISODES_IN_MEMORY)
         self.reflections: dict[str, Reflection] = {}  # level_key -> Reflection
         self.episode_counter = 0
+        self._context_cache: dict[str, str] = {}  # level_key -> 整形済みの記憶コンテキスト
+
+        # リフレクション用のレベル別インデックス（全履歴を走査せずに更新できるよう追加時に保持）
+        self._best_success: dict[str, EpisodeMemory] = {}  # level_key -> 最少ステップの成功
+        self._level_totals: Counter[str] = Counter()  # level_key -> 試行回数
+        self._level_successes: Counter[str] = Counter()  # level_key -> 成功回数
+        self._recent_failures: defaultdict[str, deque[EpisodeMemory]] = defaultdict(
+            lambda: deque(maxlen=3)
+        )
+        self._recent_by_level: defaultdict[str, deque[EpisodeMemory]] = defaultdict(
+            lambda: deque(maxlen=RECENT_EPISODES_PER_LEVEL)
+        )
+
+        # 統計情報の累計（get_statsで全エピソードを走査しないよう追加時に更新）
+        self._episode_total = 0
+        self._success_count = 0
+        self._total_reward = 0.0
+
+    def _index_episode(self, episode: EpisodeMemory):
+        """統計情報の累計とリフレクション用のレベル別インデックスを更新"""
+        level_key = episode.level_key
+        self._episode_total += 1
+        self._total_reward += episode.reward
+        self._level_totals[level_key] += 1
+        self._recent_by_level[level_key].append(episode)
+        if episode.success:
+            self._success_count += 1
+            self._level_successes[level_key] += 1
+            best = self._best_success.get(level_key)
+            if best is None or episode.steps < best.steps:
+                self._best_success[level_key] = episode
+        else:
+            self._recent_failures[level_key].append(episode)
 
     def add_episode(
         self,
@@ -101,45 +182,45 @@ class MemoryStream:
         )
 
         self.episodes.append(episode)
+        self._index_episode(episode)
 
-        # リフレクションを更新
+        # リフレクションを更新し、このレベルの記憶コンテキストを無効化
         self._update_reflection(level_key)
+        self._context_cache.pop(level_key, None)
 
         return episode
 
     def _update_reflection(self, level_key: str):
         """このレベルに関するリフレクションを更新"""
 
-        level_episodes = [e for e in self.episodes if e.level_key == level_key]
-
-        if not level_episodes:
+        total = self._level_totals[level_key]
+        if not total:
             return
 
-        successes = [e for e in level_episodes if e.success]
-        failures = [e for e in level_episodes if not e.success]
+        success_count = self._level_successes[level_key]
 
         # パターン発見
-        pattern = f"{len(successes)}/{len(level_episodes)}回成功"
+        pattern = f"{success_count}/{total}回成功"
 
         # 成功戦略
         successful_strategy = None
-        if successes:
-            # 最も効率的な成功エピソードを特定
-            best = min(successes, key=lambda e: e.steps)
+        if success_count:
+            # 最も効率的な成功エピソード（追加時にインデックス済み）
+            best = self._best_success[level_key]
             successful_strategy = (
                 f"ステップ{best.steps}でクリア: {', '.join(best.actions_taken[:5])}"
             )
 
         # 失敗したアプローチ
         failed_attempts = []
-        for failure in failures[-3:]:  # 最近の3回の失敗
+        for failure in self._recent_failures[level_key]:  # 最近の3回の失敗
             if failure.key_insight:
                 failed_attempts.append(failure.key_insight)
 
         # 改善のヒント
         improvement_hint = "まだ試行錯誤中です"
-        if len(level_episodes) >= 3:
-            if successes:
+        if total >= 3:
+            if success_count:
                 improvement_hint = f"成功パターン確立: {successful_strategy}"
             else:
                 improvement_hint = "異なるアプローチを試してください"
@@ -157,23 +238,43 @@ class MemoryStream:
         return self.reflections.get(level_key)
 
     def get_recent_episodes(self, level_key: str, limit: int = 5) -> list[EpisodeMemory]:
-        """最近のエピソードを取得"""
-        level_episodes = [e for e in self.episodes if e.level_key == level_key]
-        return level_episodes[-limit:]
+        """最近のエピソードを取得（最大RECENT_EPISODES_PER_LEVEL件）"""
+        level_episodes = self._recent_by_level.get(level_key)
+        if not level_episodes:
+            return []
+        return list(islice(level_episodes, max(0, len(level_episodes) - limit), None))
+
+    def get_latest_episodes(self, limit: int = 10) -> list[EpisodeMemory]:
+        """レベルを問わず最新のエピソードを古い順に取得"""
+        return list(islice(reversed(self.episodes), limit))[::-1]
+
+    @property
+    def episode_count(self) -> int:
+        """記録済みの総エピソード数（メモリ上から追い出された分も含む）"""
+        return self._episode_total
+
+    def get_memory_context(self, level_key: str) -> str:
+        """プロンプト用の記憶コンテキストを取得（次のエピソード追加までキャッシュを再利用）"""
+        context = self._context_cache.get(level_key)
+        if context is None:
+            context = WorldModelPrompt.create_memory_context(
+                self.get_reflection(level_key),
+                self.get_recent_episodes(level_key, limit=3),
+            )
+            self._context_cache[level_key] = context
+        return context
 
     def get_stats(self) -> dict:
         """統計情報を取得"""
-        if not self.episodes:
+        total_episodes = self._episode_total
+        if not total_episodes:
             return {"total_episodes": 0}
 
-        success_count = sum(1 for e in self.episodes if e.success)
-        total_reward = sum(e.reward for e in self.episodes)
-
         return {
-            "total_episodes": len(self.episodes),
-            "success_rate": success_count / len(self.episodes) if self.episodes else 0,
-            "total_reward": total_reward,
-            "average_reward": total_reward / len(self.episodes) if self.episodes else 0,
+            "total_episodes": total_episodes,
+            "success_rate": self._success_count / total_episodes,
+            "total_reward": self._total_reward,
+            "average_reward": self._total_reward / total_episodes,
         }
 
 
@@ -223,16 +324,38 @@ class WorldModelPrompt:
 
 あなたの目標は、物理法則を理解し、最も効率的な方法でゴールを達成することです。"""
 
+    # 回答形式の指示（全プロンプト共通の固定文）
+    RESPONSE_FORMAT = """
+**質問**: 上記の物理状況を分析し、次に取るべき最適な行動を選択してください。
+
+**回答形式** (コードブロックで囲まず、次の形のJSONオブジェクトのみを返してください):
+{
+  "reasoning": "物理的推論と戦略の説明（日本語、2-3文）",
+  "action": {
+    "type": "行動タイプ（push、barrier、wait、observe のいずれか）",
+    "forceX": 数値（pushの場合、例: 30.0）,
+    "forceY": 数値（pushの場合、例: 10.0）,
+    "duration": 数値（push/waitの場合、ミリ秒単位、例: 500）,
+    "x": 数値（barrierの場合）,
+    "y": 数値（barrierの場合）,
+    "angle": 数値（barrierの場合、度、例: 45）,
+    "focus": "文字列（observeの場合）",
+    "reason": "行動の簡潔な理由（日本語、1文）"
+  }
+}
+
+物理法則を考慮し、最も効率的な行動を選択してください。"""
+
     @staticmethod
     def create_observation_prompt(
         level: LevelConfig,
         state: dict,
         step: int,
         previous_actions: list[str],
-        reflection: Reflection | None = None,
-        recent_episodes: list[EpisodeMemory] = None,
+        memory_context: str = "",
+        level_sections: tuple[str, str] | None = None,
     ) -> str:
-        """観察データから推論プロンプトを生成"""
+        """観察データから推論プロンプトを生成（level_sectionsは事前描画済みのレベル固有セクション）"""
 
         box_pos = state["box"]["position"]
         box_vel = state["box"]["velocity"]
@@ -242,20 +365,18 @@ class WorldModelPrompt:
         # 距離とベクトルを計算
         dx = goal_pos["x"] - box_pos["x"]
         dy = goal_pos["y"] - box_pos["y"]
-        distance = (dx**2 + dy**2) ** 0.5
+        distance = hypot(dx, dy)
 
         # 速度の大きさ
-        speed = (box_vel["x"] ** 2 + box_vel["y"] ** 2) ** 0.5
-
-        prompt = f"""**現在の状況**:
+        speed = hypot(box_vel["x"], box_vel["y"])
 
-**レベル**: {level.name}
-- 説明: {level.description}
-- 時間制限: {level.time_limit}秒
-- 最大ステップ: {level.max_steps}
-- 利用可能バリア: {level.available_barriers}個
+        if level_sections is None:
+            level_sections = WorldModelPrompt.create_level_sections(level)
+        level_header, obstacles_section = level_sections
 
-**荷物の状態**:
+        # 各セクションを集めて最後に一度だけ連結する
+        parts = [level_header]
+        parts.append(f"""**荷物の状態**:
 - 位置: ({box_pos["x"]:.1f}, {box_pos["y"]:.1f})
 - 速度: ({box_vel["x"]:.2f}, {box_vel["y"]:.2f}) - 速さ: {speed:.2f} px/s
 - 質量: {level.box_mass}kg
@@ -270,61 +391,95 @@ class WorldModelPrompt:
 **進捗**:
 - 現在のステップ: {step}/{level.max_steps}
 - 経過時間: {state["elapsedTime"]:.1f}/{level.time_limit}秒
-"""
+""")
 
-        if level.obstacles:
-            prompt += f"\n**障害物**: {len(level.obstacles)}個存在\n"
-            for _i, obs in enumerate(level.obstacles):
-                prompt += f"  - {obs['type']}: ({obs['x']}, {obs['y']}) サイズ{obs['width']}x{obs['height']}\n"
+        if obstacles_section:
+            parts.append(obstacles_section)
 
         if previous_actions:
-            recent = previous_actions[-3:] if len(previous_actions) > 3 else previous_actions
-            prompt += f"\n**直前の行動**: {', '.join(recent)}\n"
+            parts.append(f"\n**直前の行動**: {', '.join(previous_actions[-3:])}\n")
 
         # 記憶ストリームからの情報を追加（Generative Agents風）
+        if memory_context:
+            parts.append(memory_context)
+
+        parts.append(WorldModelPrompt.RESPONSE_FORMAT)
+
+        return "".join(parts)
+
+    @staticmethod
+    def create_level_sections(level: LevelConfig) -> tuple[str, str]:
+        """レベル設定のみで決まるプロンプトセクション（レベル情報, 障害物）を生成"""
+
+        header = f"""**現在の状況**:
+
+**レベル**: {level.name}
+- 説明: {level.description}
+- 時間制限: {level.time_limit}秒
+- 最大ステップ: {level.max_steps}
+- 利用可能バリア: {level.available_barriers}個
+
+"""
+
+        obstacles: list[str] = []
+        if level.obstacles:
+            obstacles.append(f"\n**障害物**: {len(level.obstacles)}個存在\n")
+            for obs in level.obstacles:
+                obstacles.append(
+                    f"  - {obs['type']}: ({obs['x']}, {obs['y']}) サイズ{obs['width']}x{obs['height']}\n"
+                )
+
+        return header, "".join(obstacles)
+
+    @staticmethod
+    def create_memory_context(
+        reflection: Reflection | None = None,
+        recent_episodes: list[EpisodeMemory] = None,
+    ) -> str:
+        """リフレクションと最近のエピソードからプロンプトの記憶セクションを生成"""
+
+        parts: list[str] = []
         if reflection:
-            prompt += "\n**📚 記憶からの洞察** (エピソード履歴):\n"
-            prompt += f"- パターン: {reflection.pattern}\n"
+            parts.append("\n**📚 記憶からの洞察** (エピソード履歴):\n")
+            parts.append(f"- パターン: {reflection.pattern}\n")
             if reflection.successful_strategy:
-                prompt += f"- ✅ 成功戦略: {reflection.successful_strategy}\n"
+                parts.append(f"- ✅ 成功戦略: {reflection.successful_strategy}\n")
             if reflection.failed_attempts:
-                prompt += "- ❌ 失敗から学ぶ:\n"
+                parts.append("- ❌ 失敗から学ぶ:\n")
                 for attempt in reflection.failed_attempts[-2:]:
-                    prompt += f"  • {attempt}\n"
-            prompt += f"- 💡 改善のヒント: {reflection.improvement_hint}\n"
+                    parts.append(f"  • {attempt}\n")
+            parts.append(f"- 💡 改善のヒント: {reflection.improvement_hint}\n")
 
         if recent_episodes:
-            prompt += "\n**🧠 最近のエピソード** (最大3回):\n"
+            parts.append("\n**🧠 最近のエピソード** (最大3回):\n")
             for ep in recent_episodes[-3:]:
                 result_emoji = "✅" if ep.success else "❌"
-                prompt += f"- エピソード{ep.episode_id} {result_emoji}: ステップ{ep.steps}, 報酬{ep.reward:.0f}\n"
+                parts.append(
+                    f"- エピソード{ep.episode_id} {result_emoji}: ステップ{ep.steps}, 報酬{ep.reward:.0f}\n"
+                )
                 if ep.key_insight:
-                    prompt += f"  洞察: {ep.key_insight}\n"
+                    parts.append(f"  洞察: {ep.key_insight}\n")
 
-        prompt += """
-**質問**: 上記の物理状況を分析し、次に取るべき最適な行動を選択してください。
+        return "".join(parts)
 
-**回答形式** (必ずJSON形式で):
-```json
-{{
-  "reasoning": "物理的推論と戦略の説明（日本語、2-3文）",
-  "action": {{
-    "type": "push" | "barrier" | "wait" | "observe",
-    "forceX": 数値（pushの場合、例: 30.0）,
-    "forceY": 数値（pushの場合、例: 10.0）,
-    "duration": 数値（push/waitの場合、ミリ秒単位、例: 500）,
-    "x": 数値（barrierの場合）,
-    "y": 数値（barrierの場合）,
-    "angle": 数値（barrierの場合、度、例: 45）,
-    "focus": "文字列（observeの場合）",
-    "reason": "行動の簡潔な理由（日本語、1文）"
-  }}
-}}
-```
 
-物理法則を考慮し、最も効率的な行動を選択してください。"""
+# 定義済みレベルのレベル固有セクション（LEVELSのキー -> (レベル情報, 障害物)）
+_LEVEL_SECTIONS = {
+    key: WorldModelPrompt.create_level_sections(level) for key, level in LEVELS.items()
+}
 
-        return prompt
+# システムプロンプトは不変なので、Partとして一度だけ構築して全リクエストで共有
+_SYSTEM_PROMPT_PART = Part.from_text(WorldModelPrompt.SYSTEM_PROMPT)
+
+# JSONのみを返させ、```json ... ``` のようなコードフェンスの除去を不要にする
+_GENERATION_CONFIG = GenerationConfig(response_mime_type="application/json")
+
+
+class GeminiDecision(BaseModel):
+    """Geminiが返すJSON（推論と行動）"""
+
+    reasoning: str = Field(default="", description="物理的推論と戦略")
+    action: Action = Field(description="選択された行動")
 
 
 class WorldModelResponse(BaseModel):
@@ -360,64 +515,48 @@ async def analyze_and_decide(
         WorldModelResponse: 推論結果と選択された行動
     """
 
-    # 記憶から関連情報を取得
-    reflection = None
-    recent_episodes = []
-    if memory_stream:
-        reflection = memory_stream.get_reflection(level_key)
-        recent_episodes = memory_stream.get_recent_episodes(level_key, limit=3)
+    # 記憶から関連情報を取得（エピソード追加まではキャッシュ済みの文字列を再利用）
+    memory_context = memory_stream.get_memory_context(level_key) if memory_stream else ""
 
     # プロンプトを生成
-    system_prompt = WorldModelPrompt.SYSTEM_PROMPT
+    # 定義済みレベルはimport時に描画したセクションを再利用する
+    level_sections = _LEVEL_SECTIONS.get(level_key) if LEVELS.get(level_key) is level else None
     observation_prompt = WorldModelPrompt.create_observation_prompt(
-        level, state, step, previous_actions, reflection, recent_episodes
+        level, state, step, previous_actions, memory_context, level_sections
     )
 
-    # Gemini APIに問い合わせ
-    full_prompt = f"{system_prompt}\n\n{observation_prompt}"
-
-    response = await gemini_model.generate_content_async(full_prompt)
-
-    # レスポンスをパース
-    response_text = response.text
-
-    # JSONブロックを抽出（```json ... ``` 形式に対応）
-    json_text = response_text
-    if "```json" in response_text:
-        json_start = response_text.find("```json") + 7
-        json_end = response_text.find("```", json_start)
-        json_text = response_text[json_start:json_end].strip()
-    elif "```" in response_text:
-        json_start = response_text.find("```") + 3
-        json_end = response_text.find("```", json_start)
-        json_text = response_text[json_start:json_end].strip()
+    # Gemini APIに問い合わせ（システムプロンプトは事前構築済みのPartを再利用）
+    async with _gemini_semaphore:
+        if _gemini_bucket:
+            await _gemini_bucket.acquire()
+        response = await gemini_model.generate_content_async(
+            [_SYSTEM_PROMPT_PART, observation_prompt],
+            generation_config=_GENERATION_CONFIG,
+        )
 
+    # レスポンスをパース（response_mime_typeによりJSONのみが返る）
+    response_text = ""
     try:
-        parsed = json.loads(json_text)
-        reasoning = parsed.get("reasoning", "")
-        action_dict = parsed.get("action", {})
+        # 安全フィルタ等で候補が空の場合、response.textが理由付きの例外を送出する
+        response_text = response.text
 
-        # Actionモデルに変換
-        action = Action(**action_dict)
+        # 中間のdictを作らず、JSON文字列から直接モデルへ検証
+        decision = GeminiDecision.model_validate_json(response_text)
 
-        return WorldModelResponse(
-            reasoning=reasoning,
-            action=action,
+        return WorldModelResponse.model_construct(
+            reasoning=decision.reasoning,
+            action=decision.action,
             raw_response=response_text,
         )
 
-    except (json.JSONDecodeError, Exception) as e:
+    except Exception as e:
         # パースに失敗した場合は安全な待機アクションを返す
-        print(f"⚠️  Failed to parse Gemini response: {e}")
-        print(f"Raw response: {response_text}")
+        logger.warning("⚠️  Failed to parse Gemini response: %s", e)
+        logger.warning("Raw response: %s", response_text)
 
         return WorldModelResponse(
             reasoning="応答のパースに失敗したため、観察を実行します",
-            action=Action(
-                type="observe",
-                focus="state",
-                reason="応答解析エラー",
-            ),
+            action=Action(type="observe", focus="state", reason="応答解析エラー"),
             raw_response=response_text,
         )
 